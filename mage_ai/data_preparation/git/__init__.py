@@ -1,12 +1,14 @@
 import asyncio
+import codecs
 import os
 import shutil
 import subprocess
+import threading
 import uuid
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Callable, Dict, List
-from urllib.parse import urlparse, urlsplit, urlunsplit
+from urllib.parse import urlparse
 
 from mage_ai.authentication.oauth.constants import ProviderName
 from mage_ai.data_preparation.git.constants import DEFAULT_KNOWN_HOSTS_FILE
@@ -23,6 +25,7 @@ from mage_ai.data_preparation.git.utils import (
     get_provider_from_remote_url,
     poll_process_with_timeout,
     run_command,
+    run_sync,
     validate_authentication_for_remote_url,
 )
 from mage_ai.data_preparation.preferences import get_preferences
@@ -37,6 +40,50 @@ REMOTE_NAME = 'mage-repo'
 
 logger = Logger().new_server_logger(__name__)
 
+_repo_cache = threading.local()
+
+
+def get_repo(repo_path: str) -> Any:
+    """
+    Get a git.Repo for the repo path, reusing a cached one when possible. Creating
+    a Repo parses the git config and index, and on a web server the same repo path
+    is used for every request. The cached Repo is keyed by the real path and only
+    reused while the mtime of .git/index is unchanged.
+
+    The cache is thread local: remote commands mutate the Repo's environment via
+    custom_environment (GIT_SSH_COMMAND), so sharing a Repo across threads would
+    let one thread clear the environment while another thread's push or fetch is
+    still running.
+    """
+    import git
+
+    repos = getattr(_repo_cache, 'repos', None)
+    if repos is None:
+        repos = _repo_cache.repos = {}
+
+    real_path = os.path.realpath(repo_path)
+    index_file = os.path.join(real_path, '.git', 'index')
+    try:
+        index_mtime = os.path.getmtime(index_file)
+    except OSError:
+        index_mtime = None
+
+    if index_mtime is not None:
+        cached = repos.get(real_path)
+        if cached and cached[0] == index_mtime:
+            return cached[1]
+
+    repo = git.Repo(repo_path)
+    if index_mtime is not None:
+        repos[real_path] = (index_mtime, repo)
+    return repo
+
+
+def invalidate_repo_cache(repo_path: str) -> None:
+    repos = getattr(_repo_cache, 'repos', None)
+    if repos is not None:
+        repos.pop(os.path.realpath(repo_path), None)
+
 
 class Git:
     def __init__(
@@ -58,6 +105,11 @@ class Git:
         self.origin = None
         self.remote_repo_link = None
         self.repo = None
+        self._access_token = None
+        self._branches = None
+        self._connection_verified = False
+        self._current_branch = None
+        self._ssh_private_key_file = None
 
         self.project_repo_path = repo_path or get_repo_path(user=user)
 
@@ -86,7 +138,7 @@ class Git:
             self.__create_ssh_keys(overwrite=True)
 
         try:
-            self.repo = git.Repo(self.repo_path)
+            self.repo = get_repo(self.repo_path)
         except git.exc.InvalidGitRepositoryError:
             if setup_repo:
                 self.__setup_repo()
@@ -94,16 +146,20 @@ class Git:
         self.__set_git_config()
 
         if self.remote_repo_link and self.repo:
-            try:
-                self.repo.create_remote(REMOTE_NAME, self.remote_repo_link)
-            except git.exc.GitCommandError:
-                # if the remote already exists
-                pass
-
-            # replace the existing remote url if it is different from the provided url
+            self._ensure_remote(REMOTE_NAME, self.remote_repo_link)
             self.origin = self.repo.remotes[REMOTE_NAME]
-            if self.remote_repo_link not in self.origin.urls:
-                self.origin.set_url(self.remote_repo_link)
+
+    def _ensure_remote(self, name: str, url: str) -> None:
+        """
+        Make sure the remote exists and points at the provided url with a single
+        git invocation instead of separate create remote and set-url calls.
+        """
+        import git.exc
+        try:
+            self.repo.git.remote('set-url', name, url)
+        except git.exc.GitCommandError:
+            # set-url fails if the remote does not exist yet
+            self.repo.git.remote('add', name, url)
 
     def __setup_repo(self):
         import git
@@ -112,8 +168,9 @@ class Git:
         os.mkdir(tmp_path)
         repo_git = git.cmd.Git(self.repo_path)
         try:
-            # Clone the remote repo and copy over the .git folder
-            # to initialize the local repository.
+            # Clone the remote repo and move the .git folder over to initialize the
+            # local repository. Only the .git folder is kept, so skip checking out a
+            # working tree in the tmp folder that would be thrown away immediately.
             env = {}
             remote_repo_link = self.remote_repo_link
             if self.auth_type == AuthType.SSH:
@@ -135,9 +192,11 @@ class Git:
                 tmp_path,
                 origin=REMOTE_NAME,
                 as_process=True,
+                no_checkout=True,
+                **self.__clone_options(),
             )
 
-            asyncio.run(
+            run_sync(
                 poll_process_with_timeout(
                     proc,
                     error_message='Error cloning repo.',
@@ -148,7 +207,16 @@ class Git:
             git_folder = os.path.join(self.repo_path, '.git')
             tmp_git_folder = os.path.join(tmp_path, '.git')
             shutil.move(tmp_git_folder, git_folder)
+            invalidate_repo_cache(self.repo_path)
             self.repo = git.Repo(path=self.repo_path)
+            try:
+                # The clone skipped the checkout, so the index is empty and every
+                # tracked file would show up as a staged deletion. Rebuild the index
+                # from HEAD without touching the working tree.
+                self.repo.git.reset('--mixed', 'HEAD')
+            except git.exc.GitCommandError:
+                # e.g. the cloned repo is empty and has no commits yet
+                pass
         except Exception:
             self.repo = git.Repo.init(self.repo_path)
             # need to commit something to initialize the repository
@@ -156,6 +224,18 @@ class Git:
         finally:
             shutil.rmtree(tmp_path)
 
+    def __clone_options(self) -> Dict:
+        """
+        Extra arguments for git clone based on the git config. When clone_depth is
+        set, clone shallow and without blobs for commits outside the depth, which
+        transfers much less data than a full clone.
+        """
+        options = {}
+        if self.git_config and self.git_config.clone_depth:
+            options['depth'] = self.git_config.clone_depth
+            options['filter'] = 'blob:none'
+        return options
+
     @classmethod
     def get_manager(
         self,
@@ -197,14 +277,24 @@ class Git:
         if not self.repo:
             return None
 
-        return self.repo.git.branch('--show-current')
+        if self._current_branch is None:
+            self._current_branch = self.repo.git.branch('--show-current')
+
+        return self._current_branch
 
     @property
     def branches(self) -> List:
         if not self.repo:
             return []
 
-        return [branch.name for branch in self.repo.branches]
+        if self._branches is None:
+            self._branches = [branch.name for branch in self.repo.branches]
+
+        return self._branches
+
+    def _invalidate_branch_cache(self) -> None:
+        self._branches = None
+        self._current_branch = None
 
     async def check_connection(self, remote_url: str = None) -> None:
         if remote_url:
@@ -215,12 +305,15 @@ class Git:
     def _remote_command(func: Callable) -> None:
         """
         Decorator method for commands that need to connect to the remote repo. This decorator
-        will configure and test SSH settings before executing the Git command.
+        will configure and test SSH settings before executing the Git command. The connection
+        check only runs on the first decorated call for a Git instance; the result is cached
+        so that subsequent remote commands skip the extra ls-remote round trip. Call
+        `invalidate_connection` to force the check to run again.
         """
         def wrapper(self, *args, **kwargs):
             def add_host_to_known_hosts():
                 self.__add_host_to_known_hosts()
-                asyncio.run(self.check_connection())
+                run_sync(self.check_connection())
 
             if self.auth_type == AuthType.SSH:
                 url = f'ssh://{self.git_config.remote_repo_link}'
@@ -229,24 +322,26 @@ class Git:
                 private_key_file = self.__create_ssh_keys()
                 git_ssh_cmd = f'ssh -i {private_key_file}'
                 with self.repo.git.custom_environment(GIT_SSH_COMMAND=git_ssh_cmd):
-                    if not os.path.exists(DEFAULT_KNOWN_HOSTS_FILE):
-                        self.__add_host_to_known_hosts()
-                    try:
-                        asyncio.run(self.check_connection())
-                    except ChildProcessError as err:
-                        if 'Host key verification failed' in str(err):
+                    if not self._connection_verified:
+                        if not os.path.exists(DEFAULT_KNOWN_HOSTS_FILE):
+                            self.__add_host_to_known_hosts()
+                        try:
+                            run_sync(self.check_connection())
+                        except ChildProcessError as err:
+                            if 'Host key verification failed' in str(err):
+                                if hostname:
+                                    add_host_to_known_hosts()
+                            else:
+                                raise
+                        except TimeoutError:
                             if hostname:
                                 add_host_to_known_hosts()
-                        else:
-                            raise
-                    except TimeoutError:
-                        if hostname:
-                            add_host_to_known_hosts()
-                        else:
-                            raise TimeoutError(
-                                "Connecting to remote timed out, make sure your SSH key is set up properly"  # noqa: E501
-                                " and your repository host is added as a known host. More information here:"  # noqa: E501
-                                " https://docs.mage.ai/developing-in-the-cloud/setting-up-git#5-add-github-com-to-known-hosts")  # noqa: E501
+                            else:
+                                raise TimeoutError(
+                                    "Connecting to remote timed out, make sure your SSH key is set up properly"  # noqa: E501
+                                    " and your repository host is added as a known host. More information here:"  # noqa: E501
+                                    " https://docs.mage.ai/developing-in-the-cloud/setting-up-git#5-add-github-com-to-known-hosts")  # noqa: E501
+                        self._connection_verified = True
                     return func(self, *args, **kwargs)
             elif self.auth_type == AuthType.HTTPS:
                 token = self.get_access_token()
@@ -260,12 +355,21 @@ class Git:
                     )
                     self.origin.set_url(remote_repo_link)
                 try:
-                    asyncio.run(self.check_connection(remote_url=remote_repo_link))
+                    if not self._connection_verified:
+                        run_sync(self.check_connection(remote_url=remote_repo_link))
+                        self._connection_verified = True
                     return func(self, *args, **kwargs)
                 finally:
                     self.origin.set_url(url_original)
         return wrapper
 
+    def invalidate_connection(self) -> None:
+        """
+        Clear the cached connection check so that the next remote command verifies the
+        connection again. Call this after updating the git config or credentials.
+        """
+        self._connection_verified = False
+
     def add_remote(self, name: str, url: str) -> None:
         self.repo.create_remote(name, url)
 
@@ -314,35 +418,43 @@ class Git:
             if os.path.exists(lock_file):
                 os.remove(lock_file)
             return []
+        if not stdout:
+            return []
         # Untracked files prefix in porcelain mode
         prefix = '?? '
+        # Filter on the prefix in bulk first so that the escape handling below only
+        # runs on the untracked lines instead of every status line.
+        filenames = [
+            line[len(prefix):]
+            for line in stdout.splitlines()
+            if line.startswith(prefix)
+        ]
         files = []
-        if stdout:
-            for line in stdout.split('\n'):
-                # line = line.decode(defenc)
-                if not line.startswith(prefix):
-                    continue
-                filename = line[len(prefix):].rstrip('\n')
-                # Special characters are escaped
-                if filename[0] == filename[-1] == '"':
-                    filename = filename[1:-1]
-                    filename = (
-                        filename
-                        .encode('ascii')
-                        .decode('unicode_escape')
-                        .encode('latin1')
-                        .decode(defenc)
-                    )
-                files.append(filename)
-            # -------------------------------------------------------
-            return files
+        for filename in filenames:
+            # Special characters are escaped
+            if filename[:1] == filename[-1:] == '"':
+                # codecs.escape_decode handles all of git's porcelain escapes
+                # (\t, \NNN, \xNN, ...) in a single pass in C.
+                decoded_bytes, _ = codecs.escape_decode(filename[1:-1].encode('ascii'))
+                filename = decoded_bytes.decode(defenc)
+            files.append(filename)
+        # -------------------------------------------------------
+        return files
 
     @property
     def modified_files(self) -> List[str]:
         if not self.repo:
             return []
 
-        return [item.a_path for item in self.repo.index.diff(None)]
+        # git diff --name-only returns just the filenames in one subprocess, which is
+        # much faster than GitPython's pure python index.diff(None) for large repos.
+        # -z separates the names with NUL and disables C-style quoting, so non-ASCII
+        # paths come back raw instead of quoted.
+        return [
+            filename
+            for filename in self.repo.git.diff('--name-only', '-z').split('\0')
+            if filename
+        ]
 
     @_remote_command
     def submodules_update(self, repo_path: str = None) -> None:
@@ -392,12 +504,12 @@ class Git:
                             submodule_full_path,
                             tmp_full_path,
                         )
-                    url = urlsplit(submodule_url)
                     if self.auth_type == AuthType.HTTPS:
-                        user = self.git_config.username
-                        token = self.get_access_token()
-                        url = url._replace(netloc=f'{user}:{token}@{url.netloc}')
-                        url = urlunsplit(url)
+                        url = build_authenticated_remote_url(
+                            submodule_url,
+                            self.git_config.username,
+                            self.get_access_token(),
+                        )
                         # Overwrite the submodule URL with git credentials.
                         update_gitmodules(section, 'url', url)
 
@@ -420,7 +532,7 @@ class Git:
                         env=env,
                     )
 
-                    asyncio.run(
+                    run_sync(
                         poll_process_with_timeout(
                             proc,
                             error_message=f'Error updating submodule {section}.',
@@ -457,6 +569,7 @@ class Git:
             remote = self.repo.remotes[remote_name]
         remote.fetch()
         self.repo.git.reset('--hard', f'{remote.name}/{branch}')
+        self._invalidate_branch_cache()
         self.__pip_install()
 
     @_remote_command
@@ -474,6 +587,7 @@ class Git:
     @_remote_command
     def pull(self) -> None:
         self.origin.pull(self.current_branch)
+        self._invalidate_branch_cache()
         self.__pip_install()
 
     @_remote_command
@@ -483,6 +597,7 @@ class Git:
         custom_progress = git.remote.RemoteProgress()
 
         self.set_origin(remote_name)
+        self._invalidate_branch_cache()
         remote = self.repo.remotes[remote_name]
         if branch_name and len(branch_name) >= 1:
             try:
@@ -550,6 +665,7 @@ class Git:
 
     def delete_branch(self, base_branch_name: str) -> None:
         self.repo.branches[base_branch_name].delete(self.repo, base_branch_name, '-D')
+        self._invalidate_branch_cache()
 
     def merge_branch(self, base_branch_name: str, message: str = None) -> None:
         self.repo.git.merge(self.repo.branches[base_branch_name])
@@ -703,14 +819,16 @@ class Git:
 
     def commit(self, message, files: List[str] = None) -> None:
         if files:
-            for file in files:
-                self.repo.git.add(file)
+            # Stage all of the files with a single git add invocation instead of
+            # paying the subprocess startup cost once per file.
+            self.repo.git.add('--', *files)
         self.repo.index.commit(message)
 
     def commit_message(self, message: str) -> None:
         self.repo.index.commit(message)
 
     def switch_branch(self, branch, remote: str = None) -> None:
+        self._invalidate_branch_cache()
         if branch in self.repo.heads:
             self.repo.git.switch(branch)
         elif remote:
@@ -725,6 +843,7 @@ class Git:
         self.switch_remote_branch(branch, remote)
 
     def switch_remote_branch(self, branch: str, remote: str) -> None:
+        self._invalidate_branch_cache()
         if branch.startswith(remote):
             branch = branch[len(remote) + 1:]
         if branch in self.repo.heads:
@@ -738,8 +857,8 @@ class Git:
         tmp_path = f'{self.repo_path}_{str(uuid.uuid4())}'
         os.mkdir(tmp_path)
         try:
-            # Clone remote repo to a tmp folder, and copy over the contents
-            # of the tmp folder to the local repo.
+            # Clone remote repo to a tmp folder, and swap the tmp folder with
+            # the local repo folder.
             env = {}
             if self.auth_type == AuthType.SSH:
                 private_key_file = self.__create_ssh_keys()
@@ -749,32 +868,111 @@ class Git:
                 to_path=tmp_path,
                 origin=REMOTE_NAME,
                 env=env,
+                **self.__clone_options(),
             )
 
             if sync_submodules:
                 self.__submodules_update(repo_path=tmp_path)
 
-            shutil.rmtree(os.path.join(self.repo_path, '.git'))
-            shutil.copytree(
-                tmp_path,
-                self.repo_path,
-                dirs_exist_ok=True,
-                ignore=lambda x, y: ['.preferences.yaml']
-            )
-            self.repo.git.clean('-fd', exclude='.preferences.yaml')
+            backup_path = f'{self.repo_path}_{str(uuid.uuid4())}.old'
+            try:
+                cwd = os.getcwd()
+            except OSError:
+                cwd = None
+            try:
+                # Renames are constant time operations regardless of the size of the
+                # repo, so swap the cloned repo into place instead of copying over
+                # every file.
+                os.rename(self.repo_path, backup_path)
+                try:
+                    os.rename(tmp_path, self.repo_path)
+                except OSError:
+                    os.rename(backup_path, self.repo_path)
+                    raise
+            except OSError:
+                # Fall back to copying the files over if the rename fails, e.g. when
+                # the tmp folder ends up on a different filesystem.
+                shutil.rmtree(os.path.join(self.repo_path, '.git'))
+                shutil.copytree(
+                    tmp_path,
+                    self.repo_path,
+                    dirs_exist_ok=True,
+                    ignore=lambda x, y: ['.preferences.yaml']
+                )
+                self.repo.git.clean('-fd', exclude='.preferences.yaml')
+            else:
+                # The process working directory often is the repo path, and the rename
+                # moved the directory it points at. Re-enter the path so the process
+                # is not left inside the deleted backup folder.
+                if cwd and (
+                    cwd == self.repo_path or cwd.startswith(self.repo_path + os.sep)
+                ):
+                    try:
+                        os.chdir(cwd)
+                    except OSError:
+                        os.chdir(self.repo_path)
+                # Carry over local files that git ignores (logs, caches, variables),
+                # matching what the clean without -x preserved before the swap.
+                self.__copy_ignored_files(backup_path, self.repo_path)
+                preferences_file = os.path.join(backup_path, '.preferences.yaml')
+                if os.path.exists(preferences_file):
+                    shutil.copy2(
+                        preferences_file,
+                        os.path.join(self.repo_path, '.preferences.yaml'),
+                    )
+                shutil.rmtree(backup_path, ignore_errors=True)
+                invalidate_repo_cache(self.repo_path)
+                self.repo = Repo(self.repo_path)
+            self._invalidate_branch_cache()
             self.__pip_install()
         finally:
-            shutil.rmtree(tmp_path)
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+
+    def __copy_ignored_files(self, source_path: str, dest_path: str) -> None:
+        """
+        Copy the files that git ignores in source_path over to dest_path. Used when
+        swapping in a fresh clone so that local state living in the project folder
+        (pipeline logs, variables, caches) is not lost.
+        """
+        import git
+        try:
+            repo = git.Repo(source_path)
+            ignored = repo.git.ls_files(
+                '--others',
+                '--ignored',
+                '--directory',
+                '--exclude-standard',
+            )
+        except Exception:
+            logger.exception(f'Failed to list ignored files in {source_path}.')
+            return
+
+        for rel_path in ignored.splitlines():
+            source = os.path.join(source_path, rel_path)
+            dest = os.path.join(dest_path, rel_path)
+            try:
+                if os.path.isdir(source):
+                    shutil.copytree(source, dest, dirs_exist_ok=True)
+                else:
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    shutil.copy2(source, dest)
+            except OSError:
+                logger.exception(f'Failed to copy {source} to {dest}.')
 
     def __set_git_config(self):
         from git.config import GitConfigParser
-        if self.git_config:
-            if self.git_config.username:
-                self.repo.config_writer().set_value(
-                    'user', 'name', self.git_config.username).release()
-            if self.git_config.email:
-                self.repo.config_writer().set_value(
-                    'user', 'email', self.git_config.email).release()
+        if self.git_config and (self.git_config.username or self.git_config.email):
+            # Set all of the values through a single writer so that the repo config
+            # file is only parsed and written back once.
+            config_writer = self.repo.config_writer()
+            try:
+                if self.git_config.username:
+                    config_writer.set_value('user', 'name', self.git_config.username)
+                if self.git_config.email:
+                    config_writer.set_value('user', 'email', self.git_config.email)
+            finally:
+                config_writer.release()
 
         # This GitConfigParser is created in the same way that GitPython creates a
         # global config parser. We create it this way to avoid needing to create a
@@ -796,18 +994,64 @@ class Git:
         ):
             try:
                 if os.path.exists(requirements_file):
-                    cmd = f'pip3 install -r {requirements_file}'
-                    run_command(cmd)
+                    run_command(['pip3', 'install', '-r', requirements_file])
+                logger.info(f'Installing {requirements_file} completed successfully.')
+            except Exception as err:
+                logger.warning(f'Skip installing {requirements_file} due to error: {str(err)}')
+                pass
+
+    async def _pip_install_async(self) -> None:
+        """
+        Async variant of the pip install run after pull/reset. Callers that are already
+        on an event loop can await this so that the install does not block the loop for
+        the duration of the install.
+        """
+        requirements_file = os.path.join(
+            self.repo.working_dir, 'requirements.txt')
+
+        with VerboseFunctionExec(
+            f'Running "pip3 install -r {requirements_file}"',
+            verbose=True,
+        ):
+            try:
+                if os.path.exists(requirements_file):
+                    proc = await asyncio.create_subprocess_exec(
+                        'pip3',
+                        'install',
+                        '-r',
+                        requirements_file,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                    )
+                    await proc.communicate()
                 logger.info(f'Installing {requirements_file} completed successfully.')
             except Exception as err:
                 logger.warning(f'Skip installing {requirements_file} due to error: {str(err)}')
                 pass
 
     def __create_ssh_keys(self, overwrite: bool = False) -> str:
-        return create_ssh_keys(self.git_config, self.project_repo_path, overwrite=overwrite)
+        # Fetching the keys from the secrets backend is expensive, so skip it if the
+        # key file was already materialized by this instance and still exists on disk.
+        if (
+            not overwrite
+            and self._ssh_private_key_file
+            and os.path.exists(self._ssh_private_key_file)
+        ):
+            return self._ssh_private_key_file
+
+        self._ssh_private_key_file = create_ssh_keys(
+            self.git_config,
+            self.project_repo_path,
+            overwrite=overwrite,
+        )
+        return self._ssh_private_key_file
 
     def __add_host_to_known_hosts(self):
         return add_host_to_known_hosts_util(self.git_config.remote_repo_link)
 
     def get_access_token(self) -> str:
-        return get_access_token(self.git_config, self.project_repo_path)
+        # Cache the token so that repeated remote commands on the same instance only
+        # hit the secrets backend once.
+        if self._access_token is None:
+            self._access_token = get_access_token(self.git_config, self.project_repo_path)
+        return self._access_token
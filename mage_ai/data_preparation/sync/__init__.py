@@ -25,6 +25,10 @@ class GitConfig(BaseConfig):
     sync_on_start: bool = False
     sync_on_executor_start: bool = False
     sync_submodules: bool = False
+    # Clone with --depth=<clone_depth> --filter=blob:none to transfer less data.
+    # Leave unset for a full clone; history dependent commands (e.g. merge-base)
+    # may not work on a shallow clone.
+    clone_depth: int = None
     auth_type: AuthType = None
     # User settings moved to UserGitConfig, these will be used for Git syncs
     username: str = ''